@@ -2,12 +2,16 @@ import numpy as np
 from numpy.random import RandomState
 from os import path
 import os
+import threading
+from multiprocessing import Pool
 from keras.preprocessing.image import (
     ImageDataGenerator, 
     Iterator, 
+    flip_axis,
     # NumpyArrayIterator
 )
 from keras.utils.np_utils import to_categorical 
+from keras.utils import Sequence
 import keras.backend as K
 import cv2
 import dicom
@@ -70,8 +74,14 @@ def index_balancer(index_array, classes, ratio, rng):
 
 
 def read_resize_img(fname, target_size=None, target_height=None, 
-                    target_scale=None, gs_255=False, rescale_factor=None):
+                    target_scale=None, gs_255=False, rescale_factor=None, 
+                    crop_breast=False, quantize=False):
     '''Read an image (.png, .jpg, .dcm) and resize it to target size.
+    Args:
+        crop_breast ([bool]): crop and mask the breast region before the 
+                resizing, as in the png cache.
+        quantize ([bool]): quantize the resized image by quantize_img before 
+                the intensity rescaling, as in a uint8 npy cache.
     '''
     if target_size is None and target_height is None:
         raise Exception('One of [target_size, target_height] must not be None')
@@ -82,6 +92,8 @@ def read_resize_img(fname, target_size=None, target_height=None,
             img = cv2.imread(fname, cv2.IMREAD_GRAYSCALE)
         else:
             img = cv2.imread(fname, cv2.IMREAD_UNCHANGED)
+    if crop_breast:
+        img = _crop_breast(img)
     if target_height is not None:
         target_width = int(float(target_height)/img.shape[0]*img.shape[1])
     else:
@@ -90,6 +102,8 @@ def read_resize_img(fname, target_size=None, target_height=None,
         img = cv2.resize(
             img, dsize=(target_width, target_height), 
             interpolation=cv2.INTER_CUBIC)
+    if quantize:
+        img = quantize_img(img)
     img = img.astype('float32')
     if target_scale is not None:
         img_max = img.max() if img.max() != 0 else target_scale
@@ -99,6 +113,166 @@ def read_resize_img(fname, target_size=None, target_height=None,
     return img
 
 
+def _crop_breast(img):
+    '''Crop an image to its breast region and mask out the rest
+    '''
+    img = np.clip(img, 0, 65535).astype('uint16')
+    img, _ = prep.segment_breast(img)
+    return img
+
+
+def _cache_png(args):
+    '''Crop the breast region of an image and write it as a 16-bit png
+    '''
+    fname, out_name, target_size = args
+    if path.exists(out_name):
+        return
+    if path.splitext(fname)[1] == '.dcm':
+        img = dicom.read_file(fname).pixel_array
+    else:
+        img = cv2.imread(fname, cv2.IMREAD_UNCHANGED)
+    img = _crop_breast(img)
+    img = cv2.resize(img, dsize=(target_size[1], target_size[0]),
+                     interpolation=cv2.INTER_CUBIC)
+    # write to a temp file first so that a partial png is never visible.
+    tmp_name = path.splitext(out_name)[0] + '.%d.png' % os.getpid()
+    cv2.imwrite(tmp_name, img, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    os.rename(tmp_name, out_name)
+
+
+def create_png_cache(img_list, cache_dir, target_size, nb_worker=1):
+    '''Convert images (.dcm, .png) into breast-cropped and resized 16-bit
+    pngs so that they are decoded and resized only once
+    The cached images are written to a sub-folder named after the target 
+    size, e.g. 1152x896, and keep the base names of the original images. 
+    Images that already exist in the cache are skipped.
+    Args:
+        target_size ([tuple of int]): (height, width).
+    Returns:
+        the folder of the cached images.
+    '''
+    cache_dir = path.join(cache_dir, '%dx%d' % tuple(target_size))
+    if not path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    jobs = [ (fname,
+              path.join(cache_dir, path.splitext(path.basename(fname))[0] + '.png'),
+              tuple(target_size))
+             for fname in img_list ]
+    if nb_worker > 1:
+        pool = Pool(nb_worker)
+        pool.map(_cache_png, jobs)
+        pool.close()
+        pool.join()
+    else:
+        for job in jobs:
+            _cache_png(job)
+    return cache_dir
+
+
+def quantize_img(img, low_pct=1., high_pct=99.):
+    '''Quantize an image to uint8 using the percentiles of its breast region
+    The breast region is all non-zero pixels. Its intensities between the 
+    low and high percentiles are stretched to [0, 255] and the rest clipped.
+    '''
+    breast = img[img > 0]
+    if breast.size == 0:
+        return np.zeros(img.shape, dtype=np.uint8)
+    lo, hi = np.percentile(breast, [low_pct, high_pct])
+    img = (img.astype('float32') - lo)*255./max(hi - lo, 1e-7)
+    return np.round(np.clip(img, 0, 255)).astype(np.uint8)
+
+
+def create_npy_cache(img_list, cache_file, target_size, gs_255=False, 
+                     quantize=False):
+    '''Read and resize a list of images once into a memmapped .npy file
+    The images are stored as uint16 (or uint8) of shape (N, height, width) 
+    before intensity rescaling. The image file names are saved along in a 
+    .txt file with the same base name. If the cache already exists, it is 
+    reused after checking that it was made from the same image list, in 
+    the same order, with the same target size.
+    Args:
+        quantize ([bool]): store the images as uint8 by quantize_img, which 
+                takes a quarter of the memory of float32.
+    Returns:
+        a read-only memmap of the image array.
+    '''
+    shape = (len(img_list),) + tuple(target_size)
+    dtype = np.uint8 if quantize else np.uint16
+    names_file = path.splitext(cache_file)[0] + '.txt'
+    if not path.exists(cache_file):
+        # write to a temp file first so that a partial cache is never used.
+        tmp_name = cache_file + '.%d.tmp' % os.getpid()
+        arr = np.lib.format.open_memmap(tmp_name, mode='w+', 
+                                        dtype=dtype, shape=shape)
+        for i, fname in enumerate(img_list):
+            img = read_resize_img(fname, target_size, gs_255=gs_255)
+            if quantize:
+                arr[i] = quantize_img(img)
+            else:
+                arr[i] = np.clip(np.round(img), 0, 65535)
+        arr.flush()
+        del arr
+        # the names go first, so that the cache file implies them.
+        tmp_names = names_file + '.%d.tmp' % os.getpid()
+        with open(tmp_names, 'w') as f:
+            f.writelines(str(fname) + '\n' for fname in img_list)
+        os.rename(tmp_names, names_file)
+        os.rename(tmp_name, cache_file)
+    arr = np.load(cache_file, mmap_mode='r')
+    if arr.shape != shape or arr.dtype != dtype:
+        raise Exception('Image cache %s has shape %s and type %s, '
+                        'expected %s and %s' % 
+                        (cache_file, arr.shape, arr.dtype, shape, 
+                         np.dtype(dtype)))
+    if not path.exists(names_file):
+        raise Exception('Image cache %s has no file name list %s' % 
+                        (cache_file, names_file))
+    with open(names_file) as f:
+        cached_names = f.read().splitlines()
+    if cached_names != [ str(fname) for fname in img_list ]:
+        raise Exception('Image cache %s was made from a different image '
+                        'list, delete it to rebuild' % (cache_file))
+    return arr
+
+
+def estimate_img_list_norm(img_list, target_size, target_scale=None, 
+                           nb_sample=200, seed=12345):
+    '''Estimate the featurewise mean and std from a random subset of an 
+    image list, e.g. the png cache, with the images rescaled as they are 
+    for training
+    '''
+    nb_sample = min(nb_sample, len(img_list))
+    index_array = np.sort(RandomState(seed).choice(
+        len(img_list), nb_sample, replace=False))
+    imgs = np.stack([ read_resize_img(img_list[i], target_size, 
+                                      target_scale=target_scale) 
+                      for i in index_array ])
+    return float(imgs.mean()), float(imgs.std())
+
+
+def estimate_featurewise_norm(img_cache, target_scale=None, nb_sample=200, 
+                              seed=12345):
+    '''Estimate the featurewise mean and std from a random subset of an 
+    image cache, with the images rescaled as they are for training
+    '''
+    nb_sample = min(nb_sample, len(img_cache))
+    index_array = np.sort(RandomState(seed).choice(
+        len(img_cache), nb_sample, replace=False))
+    imgs = _read_cached_imgs(img_cache, index_array, target_scale)
+    return float(imgs.mean()), float(imgs.std())
+
+
+def _read_cached_imgs(img_cache, index_array, target_scale=None):
+    '''Slice images from an image cache and rescale each to target_scale
+    '''
+    imgs = img_cache[index_array].astype('float32')
+    if target_scale is not None:
+        img_max = imgs.reshape((len(imgs), -1)).max(axis=1)
+        img_max[img_max == 0] = target_scale
+        imgs *= (target_scale/img_max).reshape((-1, 1, 1))
+    return imgs
+
+
 def read_img_for_pred(fname, equalize_hist=False, data_format='channels_last', 
                       dup_3_channels=True,
                       transformer=None, standardizer=None, **kwargs):
@@ -263,11 +437,15 @@ class DMImgListIterator(Iterator):
                  data_format='default',
                  class_mode='binary', validation_mode=False,
                  balance_classes=False, all_neg_skip=0.,
-                 batch_size=32, shuffle=True, seed=None,
+                 batch_size=32, shuffle=True, seed=None, img_cache=None,
                  save_to_dir=None, save_prefix='', save_format='jpeg', verbose=True):
         '''DM image iterator
         Args:
             target_size ([tuple of int]): (height, width).
+            img_cache ([array]): an optional (N, height, width) array of the 
+                    resized images in img_list, e.g. from create_npy_cache. 
+                    When given, the images are sliced from it instead of 
+                    being read from disk.
             balance_classes ([bool or float]): Control class balance. When False 
                     or .0, no balancing is performed. When a float, it gives the 
                     ratio of negatives vs. positives. E.g., when balance_classes=2.0,
@@ -312,6 +490,10 @@ class DMImgListIterator(Iterator):
         nb_neg = np.sum(self.classes == 0)
         if verbose:
             print('There are %d cancer cases and %d normal cases.' % (nb_pos, nb_neg))
+        if img_cache is not None and \
+                img_cache.shape != (self.nb_sample,) + self.target_size:
+            raise ValueError('Image cache does not match the image list')
+        self.img_cache = img_cache
 
         super(DMImgListIterator, self).__init__(
             self.nb_sample, batch_size, shuffle, seed)
@@ -338,22 +520,27 @@ class DMImgListIterator(Iterator):
         batch_x = np.zeros((current_batch_size,) + self.image_shape, dtype='float32')
 
         # build batch of image data, read images first.
-        last_fname = None
-        for bi, ii in enumerate(index_array):  # bi: batch idx; ii: img idx.
-            fname = self.filenames[ii]
-            if fname == last_fname:
-                batch_x[bi] = batch_x[bi-1]  # avoid repeated readings.
-            else:
-                last_fname = fname
-                img = read_resize_img(
-                    fname, self.target_size, target_scale=self.target_scale, 
-                    gs_255=self.gs_255)
-                # Always have one channel.
-                if self.data_format == 'channels_first':
-                    x = img.reshape((1, img.shape[0], img.shape[1]))
+        if self.img_cache is not None:
+            imgs = _read_cached_imgs(self.img_cache, index_array, 
+                                     self.target_scale)
+            batch_x[:] = imgs.reshape(batch_x.shape)
+        else:
+            last_fname = None
+            for bi, ii in enumerate(index_array):  # bi: batch idx; ii: img idx.
+                fname = self.filenames[ii]
+                if fname == last_fname:
+                    batch_x[bi] = batch_x[bi-1]  # avoid repeated readings.
                 else:
-                    x = img.reshape((img.shape[0], img.shape[1], 1))
-                batch_x[bi] = x
+                    last_fname = fname
+                    img = read_resize_img(
+                        fname, self.target_size, target_scale=self.target_scale, 
+                        gs_255=self.gs_255)
+                    # Always have one channel.
+                    if self.data_format == 'channels_first':
+                        x = img.reshape((1, img.shape[0], img.shape[1]))
+                    else:
+                        x = img.reshape((img.shape[0], img.shape[1], 1))
+                    batch_x[bi] = x
 
         # transform and standardize.
         for i, x in enumerate(batch_x):
@@ -388,30 +575,428 @@ class DMImgListIterator(Iterator):
         return batch_x, batch_y
 
 
-class DMExamListIterator(Iterator):
-    '''An iterator for a flatten exam list
+# Per-process registry of the bulky read-only data of the sequences. Worker 
+# processes are forked after a sequence is created, so they inherit it.
+_SEQUENCE_DATA = {}
+# Per-process cache of what each process builds for itself, e.g. batch 
+# schedules and memmaps, keyed by (sequence uid, pid). It outlives the 
+# sequence copies that Keras unpickles for every batch.
+_SEQUENCE_CACHE = {}
+
+
+class DMSequence(Sequence):
+    '''Base class for sequences built in worker processes
+    With use_multiprocessing=True, Keras pickles the sequence for every 
+    batch. The attributes in _SHARED_ATTRS are left out of the pickle and 
+    looked up in the registry inherited from the parent process instead. 
+    The attributes in _LOCAL_ATTRS (e.g. buffers) are not sent either; they 
+    are reset to None and rebuilt lazily. Whatever a process may reuse 
+    across batches goes into _get_cache instead.
+    Keras' OrderedEnqueuer calls on_epoch_end right after it has submitted 
+    the last batch, while some batches are still pending. So the epoch is 
+    carried by the index rather than read from a counter: the sequence spans 
+    nb_epoch epochs and index i is batch i % epoch_len() of epoch 
+    i // epoch_len(). Set nb_epoch so that the sequence covers all the 
+    steps of training; on_epoch_end only matters when it wraps around.
+    A subclass sets nb_sample, batch_size, shuffle, seed, all_neg_skip, 
+    classes and nb_epoch, and implements _get_batch(epoch, idx) on top of 
+    the batch schedule from _get_batches.
     '''
+    _SHARED_ATTRS = ()
+    _LOCAL_ATTRS = ()
 
-    def __init__(self, exam_list, image_data_generator,
+    def _register(self):
+        '''Put the shared attributes into the registry
+        Call this at the end of __init__.
+        '''
+        self.uid = '%d-%d' % (os.getpid(), id(self))
+        self.cycles_seen = 0
+        _SEQUENCE_DATA[self.uid] = { 
+            attr: getattr(self, attr) for attr in self._SHARED_ATTRS }
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in self._SHARED_ATTRS + self._LOCAL_ATTRS:
+            state.pop(attr, None)
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        try:
+            self.__dict__.update(_SEQUENCE_DATA[self.uid])
+        except KeyError:
+            raise RuntimeError(
+                'Sequence data not found. Worker processes must be forked '
+                'after the sequence is created.')
+        for attr in self._LOCAL_ATTRS:
+            setattr(self, attr, None)
+
+
+    def _get_cache(self):
+        return _SEQUENCE_CACHE.setdefault((self.uid, os.getpid()), {})
+
+
+    def _make_schedule(self, epoch):
+        '''Shuffle the samples and split them into batches
+        Each all-negative batch is skipped with probability all_neg_skip. 
+        Its slot is refilled with one of the kept batches, so that the 
+        number of batches is the same in every epoch, as Keras requires. 
+        This does not save any image reading: like the skipping loop of the 
+        iterators, it only shifts the class mix towards positive batches, 
+        which are then seen more than once per epoch.
+        '''
+        rng = RandomState(self.seed + epoch)
+        if self.shuffle:
+            index_array = rng.permutation(self.nb_sample)
+        else:
+            index_array = np.arange(self.nb_sample)
+        batches = [ index_array[i:i + self.batch_size] 
+                    for i in xrange(0, self.nb_sample, self.batch_size) ]
+        if self.all_neg_skip > 0:
+            all_neg = np.array([ not np.any(self.classes[b] != 0) 
+                                 for b in batches ])
+            skip = all_neg & (rng.uniform(size=len(batches)) < self.all_neg_skip)
+            kept = np.where(~skip)[0]
+            if len(kept) > 0:
+                for i in np.where(skip)[0]:
+                    batches[i] = batches[rng.choice(kept)]
+        return batches
+
+
+    def _get_batches(self, epoch):
+        '''Get the schedule of an epoch
+        It is rebuilt from the seed once per epoch by each process instead 
+        of being sent to the worker processes with every batch. The batches 
+        of two epochs may be in flight together, so the schedule of the 
+        previous epoch is kept as well.
+        '''
+        schedules = self._get_cache().setdefault('schedules', {})
+        try:
+            return schedules[epoch]
+        except KeyError:
+            batches = self._make_schedule(epoch)
+            for e in schedules.keys():
+                if e < epoch - 1:
+                    schedules.pop(e, None)
+            schedules[epoch] = batches
+            return batches
+
+
+    def epoch_len(self):
+        return int(np.ceil(float(self.nb_sample)/self.batch_size))
+
+
+    def __len__(self):
+        # Keras reads the length once, so it must not change over epochs.
+        return self.epoch_len()*self.nb_epoch
+
+
+    def __getitem__(self, idx):
+        epoch_len = self.epoch_len()
+        epoch = self.cycles_seen*self.nb_epoch + idx//epoch_len
+        return self._get_batch(epoch, idx % epoch_len)
+
+
+    def on_epoch_end(self):
+        # Only reached when the enqueuer wraps around the whole sequence.
+        self.cycles_seen += 1
+
+
+class DMImgListSequence(DMSequence):
+    '''A keras Sequence for a flatten image list with binary labels
+    Batches are built by index, so fit_generator can build them in worker 
+    processes with use_multiprocessing=True. The batch schedule is redrawn 
+    for each epoch, so all-negative batches are skipped before any image 
+    is read.
+    '''
+    _SHARED_ATTRS = ('filenames', 'classes')
+    _LOCAL_ATTRS = DMSequence._LOCAL_ATTRS + ('_buffers', '_lock')
+
+    def __init__(self, img_list, lab_list, image_data_generator,
                  target_size=(1152, 896), target_scale=4095, gs_255=False, 
-                 data_format='default',
-                 class_mode='binary', validation_mode=False, prediction_mode=False, 
-                 balance_classes=False, all_neg_skip=0.,
-                 batch_size=16, shuffle=True, seed=None,
-                 save_to_dir=None, save_prefix='', save_format='jpeg', verbose=True):
+                 data_format='default', validation_mode=False,
+                 balance_classes=False, all_neg_skip=0., 
+                 batch_size=32, shuffle=True, seed=None, nb_epoch=1, 
+                 img_cache=None, nb_buffer=0):
+        '''DM image sequence
+        Args:
+            img_cache ([str]): an optional .npy file of the resized images 
+                    in img_list, e.g. from create_npy_cache. It is memory 
+                    mapped by each process when first needed.
+            seed ([int]): the schedule and random transforms only depend 
+                    on the seed, the epoch and the batch index, so that 
+                    every worker process builds the same batches. A seed 
+                    is drawn if not given.
+            nb_epoch ([int]): the number of epochs spanned by the sequence, 
+                    see DMSequence.
+            nb_buffer ([int]): if > 0, batches are built in place in a ring 
+                    of nb_buffer preallocated arrays instead of new arrays. 
+                    The slots are handed out in call order, so a returned 
+                    batch is overwritten nb_buffer calls later and 
+                    nb_buffer must exceed the number of batches in flight. 
+                    Keras' OrderedEnqueuer can hold max_queue_size + 2 of 
+                    them: the queued ones, one blocked on the full queue and 
+                    the one being trained on. So use at least 
+                    max_queue_size + 3. Only use it with thread workers; 
+                    worker processes copy every batch anyway.
+            others: see DMImgListIterator.
+        '''
+        if data_format == 'default':
+            data_format = K.image_data_format()
+        self.image_data_generator = image_data_generator
+        self.target_size = tuple(target_size)
+        self.target_scale = target_scale
+        self.gs_255 = gs_255
+        self.data_format = data_format
+        # Always gray-scale.
+        if self.data_format == 'channels_last':
+            self.image_shape = self.target_size + (1,)
+        else:
+            self.image_shape = (1,) + self.target_size
+        self.validation_mode = validation_mode
+        if validation_mode:
+            balance_classes = False
+            all_neg_skip = 0.
+            shuffle = False
+        self.balance_classes = balance_classes
+        self.all_neg_skip = all_neg_skip
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = np.random.randint(2**31 - 1) if seed is None else int(seed)
+        self.filenames = np.asarray(img_list)
+        self.classes = np.asarray(lab_list)
+        self.nb_sample = len(self.filenames)
+        self.nb_epoch = nb_epoch
+        self.img_cache = img_cache
+        if img_cache is not None and \
+                self._get_img_cache().shape != (self.nb_sample,) + self.target_size:
+            raise ValueError('Image cache does not match the image list')
+        self.nb_buffer = nb_buffer
+        self._buffers = None
+        self._next_buffer = 0
+        self._lock = threading.Lock()
+        self._register()
+
+
+    def _get_img_cache(self):
+        cache = self._get_cache()
+        if 'img_cache' not in cache:
+            cache['img_cache'] = np.load(self.img_cache, mmap_mode='r')
+        return cache['img_cache']
+
+
+    def __setstate__(self, state):
+        super(DMImgListSequence, self).__setstate__(state)
+        self._lock = threading.Lock()
+
+
+    def _get_batch(self, epoch, idx):
+        index_array = self._get_batches(epoch)[idx]
+        # The random state only depends on the epoch and the batch index 
+        # so that batches are reproducible in any worker.
+        rng = RandomState(self.seed + epoch*self.epoch_len() + idx)
+        if self.balance_classes:
+            ratio = float(self.balance_classes)  # neg vs. pos.
+            index_array = index_balancer(
+                index_array, self.classes[index_array], ratio, rng)
+
+        if self.nb_buffer > 0:
+            with self._lock:
+                if self._buffers is None:
+                    self._buffers = [ 
+                        np.zeros((self.batch_size,) + self.image_shape, 
+                                 dtype='float32') 
+                        for _ in xrange(self.nb_buffer) ]
+                slot = self._next_buffer
+                self._next_buffer = (slot + 1) % self.nb_buffer
+            batch_x = self._buffers[slot][:len(index_array)]
+        else:
+            batch_x = np.zeros((len(index_array),) + self.image_shape, 
+                               dtype='float32')
+        if self.img_cache is not None:
+            imgs = _read_cached_imgs(self._get_img_cache(), index_array, 
+                                     self.target_scale)
+            batch_x[:] = imgs.reshape(batch_x.shape)
+        else:
+            last_fname = None
+            for bi, ii in enumerate(index_array):
+                fname = self.filenames[ii]
+                if fname == last_fname:
+                    batch_x[bi] = batch_x[bi-1]  # avoid repeated readings.
+                else:
+                    last_fname = fname
+                    img = read_resize_img(
+                        fname, self.target_size, target_scale=self.target_scale, 
+                        gs_255=self.gs_255)
+                    batch_x[bi] = img.reshape(self.image_shape)
+        self.image_data_generator.transform_batch(
+            batch_x, random_transform=not self.validation_mode, rng=rng)
+        batch_y = self.classes[index_array].astype('float32')
+        return batch_x, batch_y
+
 
+# Number of unreadable image dataframes reported by this process. Only the 
+# first _MAX_READ_ERRORS are printed.
+_read_errors = [0]
+_read_errors_lock = threading.Lock()
+_MAX_READ_ERRORS = 10
+
+
+class ExamListMixin(object):
+    '''Attributes and image reading shared by the exam iterator and sequence
+    '''
+
+    def _init_exam_list(self, exam_list, image_data_generator, target_size, 
+                        target_scale, gs_255, data_format, 
+                        crop_breast=False, quantize=False):
         if data_format == 'default':
             data_format = K.image_data_format()
         self.image_data_generator = image_data_generator
         self.target_size = tuple(target_size)
         self.target_scale = target_scale
         self.gs_255 = gs_255
+        self.crop_breast = crop_breast
+        self.quantize = quantize
         self.data_format = data_format
         # Always gray-scale. Two inputs: CC and MLO.
         if self.data_format == 'channels_last':
             self.image_shape = self.target_size + (1,)
         else:
             self.image_shape = (1,) + self.target_size
+        # For each exam: 0 => subj id, 1 => exam idx, 2 => exam dat.
+        self.exam_list = exam_list
+        self.classes = np.array([ (e[2]['L']['cancer'], e[2]['R']['cancer']) 
+                                  for e in exam_list ])  # (exams, breasts)
+
+
+    def _read_view(self, img_df, rng, exam=None):
+        '''Read image(s) based on different modes
+        All the images of the view in prediction mode, the canonical one in 
+        validation mode and a random one otherwise. An unreadable view 
+        gives a blank image.
+        Returns: a single image array or a list of image arrays
+        '''
+        def read(fname):
+            return read_resize_img(
+                fname, self.target_size, target_scale=self.target_scale, 
+                gs_255=self.gs_255, crop_breast=self.crop_breast, 
+                quantize=self.quantize)
+
+        try:
+            if self.prediction_mode:
+                img = [ read(fname) for fname in img_df['filename'] ]
+                if len(img) == 0:
+                    raise ValueError('empty image dataframe')
+            elif self.validation_mode:
+                img = read(img_df['filename'].iloc[0])  # read the canonical view.
+            else:  # training mode.
+                img = read(img_df['filename'].sample(1, random_state=rng).iloc[0])
+        except ValueError:
+            # The count is per process: worker processes do not share it.
+            with _read_errors_lock:
+                report = _read_errors[0] < _MAX_READ_ERRORS
+                _read_errors[0] += 1
+            if report:
+                print "Error encountered reading an image dataframe:", 
+                print img_df, "Use a blank image instead."
+                if exam is not None:
+                    print "Exam caused trouble:", exam
+            img = np.zeros(self.target_size, dtype='float32')
+        return img
+
+
+class DMExamListSequence(ExamListMixin, DMSequence):
+    '''A keras Sequence for a flatten exam list with binary labels
+    The multi-view counterpart of DMImgListSequence for training and 
+    validation. A batch of batch_size exams gives 2*batch_size breasts, 
+    each with a CC and an MLO view. A missing view is a blank image.
+    '''
+    _SHARED_ATTRS = ('exam_list', 'classes')
+
+    def __init__(self, exam_list, image_data_generator,
+                 target_size=(1152, 896), target_scale=4095, gs_255=False, 
+                 data_format='default', validation_mode=False,
+                 balance_classes=False, all_neg_skip=0., 
+                 batch_size=16, shuffle=True, seed=None, nb_epoch=1):
+        '''DM exam sequence
+        Args: see DMExamListIterator and DMImgListSequence.
+        '''
+        self._init_exam_list(exam_list, image_data_generator, target_size, 
+                             target_scale, gs_255, data_format)
+        self.prediction_mode = False
+        self.validation_mode = validation_mode
+        if validation_mode:
+            balance_classes = False
+            all_neg_skip = 0.
+            shuffle = False
+        self.balance_classes = balance_classes
+        self.all_neg_skip = all_neg_skip
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = np.random.randint(2**31 - 1) if seed is None else int(seed)
+        self.nb_sample = len(exam_list)
+        self.nb_epoch = nb_epoch
+        self._register()
+
+
+    def _get_batch(self, epoch, idx):
+        index_array = self._get_batches(epoch)[idx]
+        # The random state only depends on the epoch and the batch index 
+        # so that batches are reproducible in any worker.
+        rng = RandomState(self.seed + epoch*self.epoch_len() + idx)
+        if self.balance_classes:
+            # an exam is positive if any breast is not negative.
+            classes_ = np.any(self.classes[index_array, :] != 0, axis=1).astype(int)
+            ratio = float(self.balance_classes)  # neg vs. pos.
+            index_array = index_balancer(index_array, classes_, ratio, rng)
+
+        # an exam has two breasts: [L, R, L, R, ...]
+        batch_x_cc = np.zeros((len(index_array)*2,) + self.image_shape, 
+                              dtype='float32')
+        batch_x_mlo = np.zeros_like(batch_x_cc)
+        for ei, eidx in enumerate(index_array):
+            exam_dat = self.exam_list[eidx][2]
+            for bi, breast in enumerate(('L', 'R')):
+                for batch_x, view in ((batch_x_cc, 'CC'), (batch_x_mlo, 'MLO')):
+                    img_df = exam_dat[breast][view]
+                    if img_df is not None:
+                        img = self._read_view(
+                            img_df, rng, exam=self.exam_list[eidx])
+                        batch_x[ei*2 + bi] = img.reshape(self.image_shape)
+        # each view is a stacked array, transform it as a whole.
+        for batch_x in (batch_x_cc, batch_x_mlo):
+            self.image_data_generator.transform_batch(
+                batch_x, random_transform=not self.validation_mode, rng=rng)
+
+        flat_classes = self.classes[index_array, :].ravel()
+        flat_classes[np.isnan(flat_classes)] = 0  # fill in non-cancerous labels.
+        return [batch_x_cc, batch_x_mlo], flat_classes.astype('float32')
+
+
+class DMExamListIterator(ExamListMixin, Iterator):
+    '''An iterator for a flatten exam list
+    '''
+
+    def __init__(self, exam_list, image_data_generator,
+                 target_size=(1152, 896), target_scale=4095, gs_255=False, 
+                 data_format='default',
+                 class_mode='binary', validation_mode=False, prediction_mode=False, 
+                 balance_classes=False, all_neg_skip=0.,
+                 batch_size=16, shuffle=True, seed=None, 
+                 crop_breast=False, quantize=False,
+                 save_to_dir=None, save_prefix='', save_format='jpeg', verbose=True):
+        '''DM exam iterator
+        Args:
+            crop_breast ([bool]): crop the breast region of the images, for 
+                    models trained on the png cache.
+            quantize ([bool]): quantize the images by quantize_img, for 
+                    models trained on a uint8 npy cache.
+        '''
+        self._init_exam_list(exam_list, image_data_generator, target_size, 
+                             target_scale, gs_255, data_format, 
+                             crop_breast=crop_breast, quantize=quantize)
         if class_mode not in {'categorical', 'binary', 'sparse', None}:
             raise ValueError('Invalid class_mode:', class_mode,
                              '; expected one of "categorical", '
@@ -430,15 +1015,8 @@ class DMExamListIterator(Iterator):
         self.save_prefix = save_prefix
         self.save_format = save_format
         self.verbose = verbose
-        # Convert exam list.
-        self.exam_list = exam_list
         self.nb_exam = len(exam_list)
         self.nb_class = 2
-        self.err_counter = 0
-        # For each exam: 0 => subj id, 1 => exam idx, 2 => exam dat.
-        self.classes = [ (e[2]['L']['cancer'], e[2]['R']['cancer']) 
-                         for e in exam_list ]
-        self.classes = np.array(self.classes)  # (exams, breasts)
         if verbose:
             print('For left breasts, normal=%d, cancer=%d, unimaged/masked=%d.' % 
                 (np.sum(self.classes[:, 0] == 0), 
@@ -458,15 +1036,14 @@ class DMExamListIterator(Iterator):
     def next(self):
         with self.lock:
             index_array, current_index, current_batch_size = next(self.index_generator)
-            classes_ = np.array([ 1 if p[0] or p[1] else 0 for 
-                                  p in self.classes[index_array, :] ])
+            # an exam is positive if any breast is not negative.
+            classes_ = np.any(self.classes[index_array, :] != 0, axis=1).astype(int)
             # Obtain the random state for the current batch.
             rng = RandomState() if self.seed is None else \
                 RandomState(int(self.seed) + self.total_batches_seen)
             while self.all_neg_skip > rng.uniform() and np.all(classes_ == 0):
                 index_array, current_index, current_batch_size = next(self.index_generator)
-                classes_ = np.array([ 1 if p[0] or p[1] else 0 for 
-                                      p in self.classes[index_array, :] ])                
+                classes_ = np.any(self.classes[index_array, :] != 0, axis=1).astype(int)
                 rng = RandomState() if self.seed is None else \
                     RandomState(int(self.seed) + self.total_batches_seen)
         if self.balance_classes:
@@ -487,36 +1064,7 @@ class DMExamListIterator(Iterator):
             batch_x_mlo = np.zeros( (current_batch_size,) + self.image_shape, dtype='float32' )
 
         def draw_img(img_df, exam=None):
-            '''Read image(s) based on different modes
-            Returns: a single image array or a list of image arrays
-            '''
-            try:
-                if self.prediction_mode:
-                    img = []
-                    for fname in img_df['filename']:
-                        img.append(read_resize_img(
-                            fname, self.target_size, 
-                            target_scale=self.target_scale, 
-                            gs_255=self.gs_255))
-                    if len(img) == 0:
-                        raise ValueError('empty image dataframe')
-                else:
-                    if self.validation_mode:
-                        fname = img_df['filename'].iloc[0]  # read the canonical view.
-                    else:  # training mode.
-                        fname = img_df['filename'].sample(1, random_state=rng).iloc[0]
-                    img = read_resize_img(
-                        fname, self.target_size, target_scale=self.target_scale, 
-                        gs_255=self.gs_255)
-            except ValueError:
-                if self.err_counter < 10:
-                    print "Error encountered reading an image dataframe:", 
-                    print img_df, "Use a blank image instead."
-                    print "Exam caused trouble:", exam
-                    self.err_counter += 1
-                img = np.zeros(self.target_size, dtype='float32')
-
-            return img
+            return self._read_view(img_df, rng, exam=exam)
 
         def read_breast_imgs(breast_dat, **kwargs):
             '''Read the images for both views for a breast
@@ -589,8 +1137,8 @@ class DMExamListIterator(Iterator):
                 batch_exam.append(exam_idx)
 
         # transform and standardize.
-        for i in xrange(current_batch_size):
-            if self.prediction_mode:
+        if self.prediction_mode:
+            for i in xrange(current_batch_size):
                 for ii, img_cc_ in enumerate(batch_x_cc[i]):
                     if not np.all(img_cc_ == 0):
                         batch_x_cc[i][ii] = \
@@ -599,19 +1147,12 @@ class DMExamListIterator(Iterator):
                     if not np.all(img_mlo_ == 0):
                         batch_x_mlo[i][ii] = \
                             self.image_data_generator.standardize(img_mlo_)
-            else:
-                if not np.all(batch_x_cc[i] == 0):
-                    if not self.validation_mode:
-                        batch_x_cc[i] = self.image_data_generator.\
-                            random_transform(batch_x_cc[i])
-                    batch_x_cc[i] = self.image_data_generator.\
-                        standardize(batch_x_cc[i])
-                if not np.all(batch_x_mlo[i] == 0):
-                    if not self.validation_mode:
-                        batch_x_mlo[i] = self.image_data_generator.\
-                            random_transform(batch_x_mlo[i])
-                    batch_x_mlo[i] = self.image_data_generator.\
-                        standardize(batch_x_mlo[i])
+        else:
+            # each view is a stacked array, transform it as a whole.
+            for batch_x in (batch_x_cc, batch_x_mlo):
+                self.image_data_generator.transform_batch(
+                    batch_x, random_transform=not self.validation_mode, 
+                    rng=rng)
 
         # optionally save augmented images to disk for debugging purposes
         if self.save_to_dir:
@@ -1290,11 +1831,96 @@ class DMImageDataGenerator(ImageDataGenerator):
             data_format=data_format)
 
 
+    def _flips_only(self):
+        '''Whether random_transform does nothing but flips
+        '''
+        return not (self.rotation_range or self.width_shift_range or 
+                    self.height_shift_range or self.shear_range or 
+                    self.channel_shift_range or 
+                    self.zoom_range[0] != 1 or self.zoom_range[1] != 1)
+
+
+    def standardize(self, x):
+        '''Standardize an image
+        Same as the Keras one except that the samplewise statistics of a
+        1-channel image are taken over the whole image instead of across
+        the channel axis, which would zero the image out.
+        '''
+        if x.shape[self.channel_axis - 1] != 1 or \
+                not (self.samplewise_center or self.samplewise_std_normalization):
+            return super(DMImageDataGenerator, self).standardize(x)
+        if self.preprocessing_function:
+            x = self.preprocessing_function(x)
+        if self.rescale:
+            x *= self.rescale
+        if self.samplewise_center:
+            x -= np.mean(x)
+        if self.samplewise_std_normalization:
+            x /= (np.std(x) + 1e-7)
+        if self.featurewise_center and self.mean is not None:
+            x -= self.mean
+        if self.featurewise_std_normalization and self.std is not None:
+            x /= (self.std + 1e-7)
+        if self.zca_whitening and self.principal_components is not None:
+            flatx = np.reshape(x, (-1, np.prod(x.shape[-3:])))
+            whitex = np.dot(flatx, self.principal_components)
+            x = np.reshape(whitex, x.shape)
+        return x
+
+
+    def transform_batch(self, X, random_transform=True, rng=None):
+        '''Randomly transform and standardize a 4-D image batch in place
+        All-zero images (i.e. missing views) are left untouched. Flips and 
+        normalizations are done as numpy ops over the whole batch. Other 
+        random transforms fall back to per-image processing.
+        Args:
+            X (array): a batch of images.
+            random_transform ([bool]): whether to do random transforms.
+            rng ([RandomState]): random state for the flips.
+        '''
+        nonblank = np.any(X.reshape((X.shape[0], -1)) != 0, axis=1)
+        if not np.any(nonblank):
+            return X
+        if self.zca_whitening or self.preprocessing_function is not None or \
+                (random_transform and not self._flips_only()):
+            for i in np.where(nonblank)[0]:
+                if random_transform:
+                    X[i] = self.random_transform(X[i])
+                X[i] = self.standardize(X[i])
+            return X
+
+        rng = np.random if rng is None else rng
+        x = X[nonblank]
+        if random_transform:
+            if self.horizontal_flip:
+                flipped = rng.uniform(size=len(x)) < .5
+                x[flipped] = flip_axis(x[flipped], self.col_axis)
+            if self.vertical_flip:
+                flipped = rng.uniform(size=len(x)) < .5
+                x[flipped] = flip_axis(x[flipped], self.row_axis)
+        # Same as standardize but with a leading batch axis. The samplewise 
+        # statistics are taken over each whole image, not per pixel across 
+        # channels, which would zero out 1-channel images.
+        img_axes = (1, 2, 3)
+        if self.rescale:
+            x *= self.rescale
+        if self.samplewise_center:
+            x -= np.mean(x, axis=img_axes, keepdims=True)
+        if self.samplewise_std_normalization:
+            x /= (np.std(x, axis=img_axes, keepdims=True) + 1e-7)
+        if self.featurewise_center and self.mean is not None:
+            x -= self.mean
+        if self.featurewise_std_normalization and self.std is not None:
+            x /= (self.std + 1e-7)
+        X[nonblank] = x
+        return X
+
+
     def flow_from_img_list(self, img_list, lab_list, 
                            target_size=(1152, 896), target_scale=4095, gs_255=False, 
                            class_mode='binary', validation_mode=False,
                            balance_classes=False, all_neg_skip=0., 
-                           batch_size=32, shuffle=True, seed=None,
+                           batch_size=32, shuffle=True, seed=None, img_cache=None,
                            save_to_dir=None, save_prefix='', save_format='jpeg', verbose=True):
         return DMImgListIterator(
             img_list, lab_list, self, 
@@ -1302,7 +1928,7 @@ class DMImageDataGenerator(ImageDataGenerator):
             class_mode=class_mode, validation_mode=validation_mode,
             balance_classes=balance_classes, all_neg_skip=all_neg_skip,
             data_format=self.data_format,
-            batch_size=batch_size, shuffle=shuffle, seed=seed,
+            batch_size=batch_size, shuffle=shuffle, seed=seed, img_cache=img_cache,
             save_to_dir=save_to_dir, save_prefix=save_prefix, save_format=save_format,
             verbose=verbose)
 
@@ -1312,7 +1938,8 @@ class DMImageDataGenerator(ImageDataGenerator):
                             class_mode='binary',
                             validation_mode=False, prediction_mode=False,
                             balance_classes=False, all_neg_skip=0., 
-                            batch_size=16, shuffle=True, seed=None,
+                            batch_size=16, shuffle=True, seed=None, 
+                            crop_breast=False, quantize=False,
                             save_to_dir=None, save_prefix='', save_format='jpeg', verbose=True):
         return DMExamListIterator(
             exam_list, self, 
@@ -1321,7 +1948,8 @@ class DMImageDataGenerator(ImageDataGenerator):
             validation_mode=validation_mode, prediction_mode=prediction_mode,
             balance_classes=balance_classes, all_neg_skip=all_neg_skip, 
             data_format=self.data_format,
-            batch_size=batch_size, shuffle=shuffle, seed=seed,
+            batch_size=batch_size, shuffle=shuffle, seed=seed, 
+            crop_breast=crop_breast, quantize=quantize,
             save_to_dir=save_to_dir, save_prefix=save_prefix, save_format=save_format,
             verbose=verbose)
 
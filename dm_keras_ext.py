@@ -1,13 +1,18 @@
 import sys
+import threading
+import Queue
 import numpy as np
 from keras.callbacks import Callback
 from keras.models import load_model, Model
-from keras.layers import Flatten, Dense, Dropout, GlobalAveragePooling2D
+from keras.layers import (
+    Input, Flatten, Dense, Dropout, Lambda, GlobalAveragePooling2D
+)
 from keras.layers.convolutional import Conv2D
+from keras.engine.topology import InputLayer
 from keras.regularizers import l2
 from keras.optimizers import (
     SGD, RMSprop, Adagrad, Adadelta,
-    Adam, Adamax, Nadam
+    Adam, Adamax, Nadam, clip_norm
 )
 from keras.callbacks import (
     ReduceLROnPlateau, 
@@ -380,6 +385,255 @@ def do_2stage_training(model, org_model, train_generator, validation_set,
     return model, loss_history, acc_history
 
 
+FEATUREWISE_NORM_NAME = 'featurewise_norm'
+
+
+def _featurewise_norm(x, mean, std, cropped=False, quantized=False):
+    # all-zero images (i.e. missing views) are left untouched. cropped and 
+    # quantized are only recorded in the layer config, see 
+    # add_featurewise_norm.
+    nonblank = K.cast(K.any(x, axis=[1, 2, 3], keepdims=True), K.floatx())
+    return nonblank*(x - mean)/std + (1. - nonblank)*x
+
+
+def add_featurewise_norm(model, featurewise_mean, featurewise_std, 
+                         cropped=False, quantized=False):
+    '''Prepend featurewise normalization to each input of a model
+    The normalization is a Lambda layer, so it runs on the device together 
+    with the first conv layer and is saved with the model. The layers of 
+    the model are re-applied on the normalized inputs so that the returned 
+    model stays flat and layer indices (e.g. index=-2 for the last hidden 
+    layer) keep their meaning. The image generator shall not normalize 
+    the images any more.
+    Args:
+        cropped ([bool]): whether the model is trained on breast-cropped 
+                images, i.e. the png cache.
+        quantized ([bool]): whether the model is trained on images 
+                quantized by dm_image.quantize_img.
+        Both are saved with the layer so that inference can preprocess the 
+        images the same way, see get_featurewise_norm.
+    '''
+    tensor_map = {}
+    inputs = []
+    for i, x in enumerate(model.inputs):
+        name = FEATUREWISE_NORM_NAME if len(model.inputs) == 1 \
+            else FEATUREWISE_NORM_NAME + '_%d' % (i + 1)
+        input_ = Input(shape=K.int_shape(x)[1:])
+        tensor_map[x] = Lambda(_featurewise_norm, name=name,
+                               arguments={'mean': featurewise_mean, 
+                                          'std': featurewise_std,
+                                          'cropped': cropped,
+                                          'quantized': quantized})(input_)
+        inputs.append(input_)
+    # Re-apply the layers node by node, deepest first.
+    for depth in sorted(model.nodes_by_depth.keys(), reverse=True):
+        for node in model.nodes_by_depth[depth]:
+            layer = node.outbound_layer
+            if isinstance(layer, InputLayer):
+                continue
+            layer_inputs = [ tensor_map[x] for x in node.input_tensors ]
+            kwargs = node.arguments if node.arguments else {}
+            layer_outputs = layer(
+                layer_inputs if len(layer_inputs) > 1 else layer_inputs[0], 
+                **kwargs)
+            if not isinstance(layer_outputs, list):
+                layer_outputs = [layer_outputs]
+            for x, y in zip(node.output_tensors, layer_outputs):
+                tensor_map[x] = y
+    outputs = [ tensor_map[x] for x in model.outputs ]
+    return Model(inputs=inputs, 
+                 outputs=outputs if len(outputs) > 1 else outputs[0])
+
+
+def get_featurewise_norm(model):
+    '''Get the arguments of the normalization layer of a model
+    Returns:
+        a dict with mean, std, cropped and quantized (False if not 
+        recorded), or None if the model does not normalize its inputs by 
+        itself. See `add_featurewise_norm`.
+    '''
+    for layer in model.layers:
+        if layer.name.startswith(FEATUREWISE_NORM_NAME):
+            norm_args = {'cropped': False, 'quantized': False}
+            norm_args.update(layer.arguments)
+            return norm_args
+    return None
+
+
+def has_featurewise_norm(model):
+    '''Whether a model normalizes its inputs by itself
+    See `add_featurewise_norm`.
+    '''
+    return get_featurewise_norm(model) is not None
+
+
+def _get_unclipped_gradients(optimizer, get_gradients, loss, params):
+    '''Call get_gradients with the clipping of the optimizer turned off
+    The thresholds are read when the graph is built, so they are only 
+    zeroed for the call and the optimizer config keeps them.
+    '''
+    clipnorm = getattr(optimizer, 'clipnorm', None)
+    clipvalue = getattr(optimizer, 'clipvalue', None)
+    if clipnorm is not None:
+        optimizer.clipnorm = 0
+    if clipvalue is not None:
+        optimizer.clipvalue = 0
+    try:
+        return get_gradients(loss, params)
+    finally:
+        if clipnorm is not None:
+            optimizer.clipnorm = clipnorm
+        if clipvalue is not None:
+            optimizer.clipvalue = clipvalue
+
+
+def _clip_gradients(optimizer, grads):
+    '''Clip gradients by the thresholds of an optimizer
+    The same as Keras 2.0.8 Optimizer.get_gradients.
+    '''
+    if getattr(optimizer, 'clipnorm', 0) > 0:
+        norm = K.sqrt(sum([ K.sum(K.square(g)) for g in grads ]))
+        grads = [ clip_norm(g, optimizer.clipnorm, norm) for g in grads ]
+    if getattr(optimizer, 'clipvalue', 0) > 0:
+        grads = [ K.clip(g, -optimizer.clipvalue, optimizer.clipvalue) 
+                  for g in grads ]
+    return grads
+
+
+def add_loss_scaling(optimizer, loss_scale=128.):
+    '''Add static loss scaling to an optimizer for mixed precision training
+    The loss is multiplied by loss_scale before differentiation and the
+    gradients are divided by it afterwards, which keeps small fp16 gradients
+    from flushing to zero. The optimizer class is unchanged, so saved models
+    can still be loaded without custom objects.
+    '''
+    get_gradients = optimizer.get_gradients
+
+    def scaled_get_gradients(loss, params):
+        # Unscale before clipping, so that the thresholds apply to the 
+        # true gradients.
+        grads = _get_unclipped_gradients(
+            optimizer, get_gradients, loss*loss_scale, params)
+        grads = [ g/loss_scale for g in grads ]
+        return _clip_gradients(optimizer, grads)
+
+    optimizer.get_gradients = scaled_get_gradients
+    return optimizer
+
+
+def accumulate_gradients(optimizer, accum_steps):
+    '''Accumulate the gradients of an SGD optimizer over several batches
+    The parameters are updated once every accum_steps batches with the 
+    averaged gradients, so the effective batch size is accum_steps times 
+    the device batch size. Gradient clipping is applied once to the 
+    averaged gradients, not to each batch. Apply this after any other 
+    optimizer wrapper. 
+    It follows the Keras 2.0.8 SGD.get_updates(loss, params). The 
+    optimizer class is unchanged, so saved models can still be loaded 
+    without custom objects.
+    '''
+    if accum_steps <= 1:
+        return optimizer
+    get_gradients = optimizer.get_gradients
+
+    def accum_get_updates(loss, params):
+        self = optimizer
+        grads = _get_unclipped_gradients(self, get_gradients, loss, params)
+        shapes = [ K.int_shape(p) for p in params ]
+        accums = [ K.zeros(shape) for shape in shapes ]
+        moments = [ K.zeros(shape) for shape in shapes ]
+        self.weights = [self.iterations] + moments
+        # 1. on the last batch of a cycle, else 0.
+        step = K.variable(0.)
+        new_step = step + 1.
+        apply_ = K.cast(K.equal(new_step, float(accum_steps)), K.floatx())
+        self.updates = [K.update(step, new_step*(1. - apply_)), 
+                        K.update_add(self.iterations, 
+                                     K.cast(apply_, K.dtype(self.iterations)))]
+        lr = self.lr
+        if self.initial_decay > 0:
+            lr *= (1. / (1. + self.decay * K.cast(self.iterations, 
+                                                  K.dtype(self.decay))))
+
+        g_sums = [ a + g for a, g in zip(accums, grads) ]
+        g_avgs = _clip_gradients(self, [ g_sum/accum_steps for g_sum in g_sums ])
+        for p, g_sum, g_avg, a, m in zip(params, g_sums, g_avgs, accums, moments):
+            self.updates.append(K.update(a, g_sum*(1. - apply_)))
+            v = self.momentum * m - lr * g_avg
+            self.updates.append(K.update(m, apply_*v + (1. - apply_)*m))
+            if self.nesterov:
+                new_p = p + self.momentum * v - lr * g_avg
+            else:
+                new_p = p + v
+            if getattr(p, 'constraint', None) is not None:
+                new_p = p.constraint(new_p)
+            self.updates.append(K.update(p, apply_*new_p + (1. - apply_)*p))
+        return self.updates
+
+    optimizer.get_updates = accum_get_updates
+    return optimizer
+
+
+class DMPrefetcher(object):
+    '''Read a fixed number of samples from a generator in a background thread
+    Up to max_queue_size batches are read ahead, so that reading the next 
+    batch overlaps with predicting on the current one. The thread stops 
+    once nb_samples samples are read, so the generator can be reset again 
+    afterwards. Call close if the consumer stops early, e.g. on an error, 
+    so that the thread does not stay blocked on the full queue.
+    '''
+
+    def __init__(self, generator, nb_samples, max_queue_size=2):
+        self.queue = Queue.Queue(max_queue_size)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, args=(generator, nb_samples))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        '''Put an item into the queue unless the prefetcher is closed
+        Returns: whether the item was put.
+        '''
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _run(self, generator, nb_samples):
+        try:
+            samples_seen = 0
+            while samples_seen < nb_samples:
+                res = next(generator)
+                samples_seen += len(res[1])
+                if not self._put((True, res)):
+                    return
+            self._put((True, None))
+        except Exception as e:
+            self._put((False, e))
+
+    def close(self):
+        '''Stop the thread and wait for it
+        The batch being read, if any, is still finished first.
+        '''
+        self.stop_event.set()
+        self.thread.join()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        ok, res = self.queue.get()
+        if not ok:
+            raise res
+        if res is None:
+            raise StopIteration
+        return res
+
+
 class DMMetrics(object):
     '''Classification metrics for the DM challenge
     '''
@@ -429,6 +683,8 @@ class DMAucModelCheckpoint(Callback):
     def calc_test_auc(test_set, model, batch_size=None, test_samples=None,
                       return_y_res=False, test_augment=False):
         '''Calculate the AUC score for a test set or generator given a model
+        The predictions use the model's predict function, which runs in the 
+        test learning phase and builds no gradient ops.
         '''
         def augmented_predict(X, batch_size=None):
             '''Predict on a batch of images with augmentation
@@ -440,12 +696,13 @@ class DMAucModelCheckpoint(Callback):
                     if batch_size is None:
                         y_preds.append(model.predict_on_batch(X_test))
                     else:
-                        y_preds.append(model.predict(X_test, batch_size))
+                        y_preds.append(model.predict(X_test, batch_size, 
+                                                     verbose=0))
                 y_pred = np.stack(y_preds).mean(axis=0)
             elif batch_size is None:
                 y_pred = model.predict_on_batch(X)
             else:
-                y_pred = model.predict(X, batch_size)
+                y_pred = model.predict(X, batch_size, verbose=0)
             return y_pred
 
         if isinstance(test_set, tuple):
@@ -463,19 +720,20 @@ class DMAucModelCheckpoint(Callback):
                 raise Exception('test_samples must be specified when ' + \
                                 'test set is a generator')
             test_set.reset()
-            samples_seen = 0
             y_list = []
             pred_list = []
             wei_list = []
-            while samples_seen < test_samples:
-                res = next(test_set)
-                if len(res) > 2:
-                    w = res[2]
-                    wei_list.append(w)
-                X, y = res[:2]
-                samples_seen += len(y)
-                y_list.append(y)
-                pred_list.append(augmented_predict(X))
+            prefetcher = DMPrefetcher(test_set, test_samples)
+            try:
+                for res in prefetcher:
+                    if len(res) > 2:
+                        w = res[2]
+                        wei_list.append(w)
+                    X, y = res[:2]
+                    y_list.append(y)
+                    pred_list.append(augmented_predict(X))
+            finally:
+                prefetcher.close()
             y_true = np.concatenate(y_list)
             y_pred = np.concatenate(pred_list)
             if len(wei_list) > 0:
@@ -7,8 +7,8 @@ import tensorflow as tf
 def make_parallel(model, gpu_count):
     def get_slice(data, idx, parts):
         shape = tf.shape(data)
-        size = tf.concat(0, [ shape[:1]/parts, shape[1:] ])
-        stride = tf.concat(0, [ shape[:1]/parts, shape[1:]*0 ])
+        size = tf.concat([ shape[:1]/parts, shape[1:] ], 0)
+        stride = tf.concat([ shape[:1]/parts, shape[1:]*0 ], 0)
         start = stride * idx
         return tf.slice(data, start, size)
 
@@ -1,9 +1,14 @@
 import argparse
 import numpy as np
 from keras.models import load_model
+import keras.backend as K
+# The models are trained channels_last. This must be set before importing 
+# the dm_* modules because they compute their axes at import time.
+K.set_image_data_format('channels_last')
 from meta import DMMetaManager
 from dm_image import DMImageDataGenerator
 from dm_enet import MultiViewDLElasticNet
+from dm_keras_ext import get_featurewise_norm
 import dm_inference as dminfer
 
 import warnings
@@ -46,16 +51,25 @@ def run(img_folder, img_size=[288, 224], do_featurewise_norm=True,
         class_mode = 'binary'
     else:
         class_mode = None
-    datgen_exam = img_gen.flow_from_exam_list(
-        exam_list, target_size=(img_size[0], img_size[1]), 
-        class_mode=class_mode, prediction_mode=True, batch_size=batch_size)
-
     if enet_state is not None:
         model = MultiViewDLElasticNet(*enet_state)
     elif dl_state is not None:
         model = load_model(dl_state)
     else:
         raise Exception('At least one model state must be specified.')
+    # Newer models normalize their inputs by themselves and record whether 
+    # they were trained on breast-cropped or quantized images.
+    dl_model = model.repr_model if enet_state is not None else model
+    norm_args = get_featurewise_norm(dl_model)
+    if do_featurewise_norm and norm_args is not None:
+        img_gen.featurewise_center = False
+        img_gen.featurewise_std_normalization = False
+    crop_breast = norm_args is not None and norm_args['cropped']
+    quantize = norm_args is not None and norm_args['quantized']
+    datgen_exam = img_gen.flow_from_exam_list(
+        exam_list, target_size=(img_size[0], img_size[1]), 
+        class_mode=class_mode, prediction_mode=True, batch_size=batch_size, 
+        crop_breast=crop_breast, quantize=quantize)
     exams_seen = 0
     fout = open(out_pred, 'w')
 
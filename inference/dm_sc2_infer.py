@@ -3,10 +3,15 @@ import pickle
 import numpy as np
 import pandas as pd
 from keras.models import load_model
+import keras.backend as K
+# The models are trained channels_last. This must be set before importing 
+# the dm_* modules because they compute their axes at import time.
+K.set_image_data_format('channels_last')
 import xgboost as xgb
 from meta import DMMetaManager
 from dm_image import DMImageDataGenerator
 from dm_enet import MultiViewDLElasticNet
+from dm_keras_ext import get_featurewise_norm
 import dm_inference as dminfer
 
 import warnings
@@ -55,6 +60,15 @@ def run(img_folder, img_size=[288, 224], do_featurewise_norm=True,
         model = load_model(dl_state)
     else:
         raise Exception('At least one image model state must be specified.')
+    # Newer models normalize their inputs by themselves and record whether 
+    # they were trained on breast-cropped or quantized images.
+    dl_model = model.repr_model if enet_state is not None else model
+    norm_args = get_featurewise_norm(dl_model)
+    if do_featurewise_norm and norm_args is not None:
+        img_gen.featurewise_center = False
+        img_gen.featurewise_std_normalization = False
+    crop_breast = norm_args is not None and norm_args['cropped']
+    quantize = norm_args is not None and norm_args['quantized']
 
     # XGB model.
     xgb_clf = pickle.load(open(xgb_state))
@@ -83,7 +97,8 @@ def run(img_folder, img_size=[288, 224], do_featurewise_norm=True,
         datgen_exam = img_gen.flow_from_exam_list(
             exam_list, target_size=(img_size[0], img_size[1]), 
             class_mode=class_mode, prediction_mode=True, 
-            batch_size=len(exam_list), verbose=False)
+            batch_size=len(exam_list), crop_breast=crop_breast, 
+            quantize=quantize, verbose=False)
         ebat = next(datgen_exam)
         if class_mode is not None:
             bat_x = ebat[0]
@@ -13,6 +13,7 @@ from dm_enet import DLRepr
 from meta import DMMetaManager
 from dm_image import DMImageDataGenerator
 from dm_keras_ext import DMMetrics as dmm
+from dm_keras_ext import add_featurewise_norm, has_featurewise_norm
 
 import warnings
 import exceptions
@@ -236,6 +237,24 @@ def run(img_folder, dl_state, img_extension='dcm',
         roi_clf = None
         graph = None
 
+    print "Load DL representation model"; sys.stdout.flush()
+    dlrepr_model = DLRepr(
+        dl_state,
+        custom_objects={
+                'sensitivity': dmm.sensitivity, 
+                'specificity': dmm.specificity
+        },
+        layer_name=layer_name, 
+        layer_index=layer_index)
+    # Models trained by dm_resnet_train normalize their inputs by 
+    # themselves. The ROI classifier then gets the same normalization.
+    if do_featurewise_norm and has_featurewise_norm(dlrepr_model.repr_model):
+        imgen.featurewise_center = False
+        imgen.featurewise_std_normalization = False
+        if roi_clf is not None and not has_featurewise_norm(roi_clf):
+            roi_clf = add_featurewise_norm(roi_clf, featurewise_mean, 
+                                           featurewise_std)
+
     # Create ROI generators for pos and neg images separately.
     print "Create ROI generators for pos and neg images"
     sys.stdout.flush()
@@ -251,15 +270,6 @@ def run(img_folder, dl_state, img_extension='dcm',
         return_sample_weight=False, seed=random_seed)
 
     # Generate image patches and extract their DL representations.
-    print "Load DL representation model"; sys.stdout.flush()
-    dlrepr_model = DLRepr(
-        dl_state,
-        custom_objects={
-                'sensitivity': dmm.sensitivity, 
-                'specificity': dmm.specificity
-        },
-        layer_name=layer_name, 
-        layer_index=layer_index)
     last_output_size = dlrepr_model.get_output_shape()[-1][-1]
     if last_output_size != 3 and last_output_size != 1:
         raise Exception("The last output must be prob outputs (size=3 or 1)")
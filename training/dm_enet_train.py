@@ -16,7 +16,7 @@ from keras.models import load_model, Model
 from meta import DMMetaManager
 from dm_image import DMImageDataGenerator
 from dm_multi_gpu import make_parallel
-from dm_keras_ext import DMMetrics
+from dm_keras_ext import DMMetrics, has_featurewise_norm
 
 import warnings
 import exceptions
@@ -120,6 +120,10 @@ def run(img_folder, img_extension='png', img_size=[288, 224], multi_view=False,
             dl_state, 
             custom_objects={'sensitivity': DMMetrics.sensitivity, 
                             'specificity': DMMetrics.specificity})
+    # Models trained by dm_resnet_train normalize their inputs by themselves.
+    if do_featurewise_norm and has_featurewise_norm(dl_model):
+        img_gen.featurewise_center = False
+        img_gen.featurewise_std_normalization = False
     # Dummy compilation to turn off the "uncompiled" error when model was run on multi-GPUs.
     # dl_model.compile(optimizer='sgd', loss='binary_crossentropy')
     reprlayer_model = Model(
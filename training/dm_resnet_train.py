@@ -6,21 +6,64 @@ from keras.callbacks import (
 )
 from keras.optimizers import SGD
 from keras.models import load_model
+import keras.backend as K
+# NHWC is the native cuDNN layout. This must be set before importing the 
+# dm_* modules because they compute their axes at import time.
+K.set_image_data_format('channels_last')
+import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
 import os, argparse
 import numpy as np
 from meta import DMMetaManager
-from dm_image import DMImageDataGenerator
+from dm_image import (
+    DMImageDataGenerator, 
+    DMImgListSequence,
+    DMExamListSequence,
+    create_png_cache, 
+    create_npy_cache,
+    estimate_img_list_norm,
+    estimate_featurewise_norm
+)
 from dm_resnet import (
     ResNetBuilder,
     MultiViewResNetBuilder
 )
+from dm_keras_ext import (
+    DMMetrics, 
+    DMAucModelCheckpoint, 
+    add_featurewise_norm,
+    get_featurewise_norm,
+    add_loss_scaling,
+    accumulate_gradients
+)
 from dm_multi_gpu import make_parallel
-from dm_keras_ext import DMMetrics, DMAucModelCheckpoint
 
 import warnings
 import exceptions
 warnings.filterwarnings('ignore', category=exceptions.UserWarning)
 
+# Map net names to ResNetBuilder methods.
+_NET_BUILDERS = {
+    'resnet18': 'build_resnet_18',
+    'resnet34': 'build_resnet_34',
+    'resnet50': 'build_resnet_50',
+    'dmresnet14': 'build_dm_resnet_14',
+    'dmresnet47rb5': 'build_dm_resnet_47rb5',
+    'dmresnet56rb6': 'build_dm_resnet_56rb6',
+    'dmresnet65rb7': 'build_dm_resnet_65rb7',
+    'resnet101': 'build_resnet_101',
+    'resnet152': 'build_resnet_152',
+}
+
+
+def _hvd_barrier(use_horovod):
+    '''Wait until all the Horovod processes get here
+    An allreduce of a dummy tensor only completes once every rank joins it.
+    '''
+    if use_horovod:
+        import horovod.tensorflow as hvd_tf
+        K.get_session().run(hvd_tf.allreduce(tf.constant(0.)))
+
 
 def run(img_folder, img_extension='dcm', 
         img_size=[288, 224], img_scale=4095, multi_view=False,
@@ -30,8 +73,11 @@ def run(img_folder, img_extension='dcm',
         nb_init_filter=64, init_filter_size=7, init_conv_stride=2, 
         pool_size=3, pool_stride=2, weight_decay=.0001, alpha=1., l1_ratio=.5, 
         inp_dropout=.0, hidden_dropout=.0, init_lr=.01,
-        val_size=.2, lr_patience=5, es_patience=10, 
+        clipnorm=1., val_size=.2, lr_patience=5, es_patience=10, min_delta=1e-4,
         resume_from=None, net='resnet50', load_val_ram=False,
+        mixed_precision=False, loss_scale=128., use_xla=False, use_horovod=False,
+        preprocess_cache=None, grad_accum_steps=1, npy_cache=None, 
+        cache_uint8=False, worker_threads=False,
         exam_tsv='./metadata/exams_metadata.tsv',
         img_tsv='./metadata/images_crosswalk.tsv',
         best_model='./modelState/dm_resnet_best_model.h5',
@@ -41,17 +87,110 @@ def run(img_folder, img_extension='dcm',
         featurewise_mean, featurewise_std ([float]): they are estimated from 
                 1152 x 896 images. Using different sized images give very close
                 results. For png, mean=7772, std=12187.
+        clipnorm ([float]): the gradients are rescaled so that their global 
+                L2 norm does not exceed this value. Set to 0 to turn off.
+        min_delta ([float]): minimum decrease of val_loss that counts as an 
+                improvement for LR reduction and early stopping, so that 
+                fp16 noise does not reset the patience. When > 0, the LR 
+                reduction also gets a cooldown of one epoch. Set to 0 for 
+                the Keras defaults.
+        mixed_precision ([bool]): whether to let TF run the graph in fp16 
+                where it is safe to. Variables are kept in fp32 and a static 
+                loss scale is applied to the gradients. Needs TensorFlow 
+                >= 1.14.
+        use_xla ([bool]): whether to let TF JIT-compile the graph with XLA 
+                so that neighboring ops, e.g. conv-BN-ReLU, are fused. 
+                Off by default: XLA is experimental in TF 1.x and may slow 
+                down or break the graph.
+        use_horovod ([bool]): whether to do data parallel training with 
+                Horovod. Launch one process per GPU, e.g. with mpirun. The 
+                learning rate is scaled by the number of processes. 
+                Without Horovod, NUM_GPU_DEVICES > 1 replicates the model 
+                on the GPUs of a single process by make_parallel instead. 
+                With Horovod, rank 0 builds the png and npy caches while the 
+                other processes wait.
+        preprocess_cache ([str]): if given, all images are breast-cropped, 
+                resized to img_size and saved as 16-bit pngs in a sub-folder 
+                of this folder named after img_size, once. Training then 
+                reads the pngs. The featurewise mean and std are 
+                re-estimated on the cropped images and the model records 
+                the cropping so that the inference scripts crop the same 
+                way.
+        grad_accum_steps ([int]): number of batches whose gradients are 
+                averaged before each weight update. The effective batch size 
+                is batch_size*grad_accum_steps. samples_per_epoch still 
+                counts the samples seen, so there are grad_accum_steps times 
+                fewer weight updates per epoch.
+        npy_cache ([str]): if given, the resized train and val images are 
+                written once to train.npy and val.npy in this folder and 
+                later sliced from the memmapped files. Single view only. 
+                A cache made from another split or img_size is rejected, 
+                delete the files to rebuild it.
+        cache_uint8 ([bool]): whether to quantize the npy cache to uint8 
+                by the 1st and 99th percentiles of each breast. The 
+                featurewise mean and std are then re-estimated on the 
+                train cache. The model records the quantization so that 
+                the inference scripts quantize the images the same way.
+        worker_threads ([bool]): whether to build the batches with worker 
+                threads instead of worker processes. Threads build the 
+                single-view batches in place in a ring of preallocated 
+                buffers instead of pickling them back to the parent.
     '''
 
     # Read some env variables.
     random_seed = int(os.getenv('RANDOM_SEED', 12345))
     nb_worker = int(os.getenv('NUM_CPU_CORES', 4))
     gpu_count = int(os.getenv('NUM_GPU_DEVICES', 1))
+    if use_horovod and gpu_count > 1:
+        raise Exception('NUM_GPU_DEVICES > 1 cannot be combined with '
+                        '--horovod, which uses one GPU per process')
+
+    # Initialize Horovod and configure the TF session before any graph is 
+    # built. Each process is pinned to one GPU.
+    if use_horovod:
+        import horovod.keras as hvd
+        hvd.init()
+        rank, nb_proc = hvd.rank(), hvd.size()
+    else:
+        rank, nb_proc = 0, 1
+    config = tf.ConfigProto()
+    if use_horovod:
+        config.gpu_options.allow_growth = True
+        config.gpu_options.visible_device_list = str(hvd.local_rank())
+    if mixed_precision:
+        # The graph rewrite is only available from TF 1.14 on.
+        if not hasattr(rewriter_config_pb2.RewriterConfig, 
+                       'auto_mixed_precision'):
+            raise Exception('Mixed precision needs TensorFlow >= 1.14, '
+                            'found ' + tf.__version__ + '. Run with '
+                            '--no-mixed-precision.')
+        config.graph_options.rewrite_options.auto_mixed_precision = \
+            rewriter_config_pb2.RewriterConfig.ON
+    if use_xla:
+        config.graph_options.optimizer_options.global_jit_level = \
+            tf.OptimizerOptions.ON_1
+    K.set_session(tf.Session(config=config))
     
     # Setup training and validation data.
     # Load image or exam lists and split them into train and val sets.
     meta_man = DMMetaManager(exam_tsv=exam_tsv, img_tsv=img_tsv, 
                              img_folder=img_folder, img_extension=img_extension)
+    if preprocess_cache is not None:
+        print "Creating png cache in", preprocess_cache
+        img_list, _ = meta_man.get_flatten_img_list()
+        if rank == 0:
+            create_png_cache(img_list, preprocess_cache, img_size, nb_worker)
+        _hvd_barrier(use_horovod)
+        # every png is in place now, so this only gets the folder.
+        png_folder = create_png_cache(img_list, preprocess_cache, img_size)
+        meta_man = DMMetaManager(exam_tsv=exam_tsv, img_tsv=img_tsv, 
+                                 img_folder=png_folder, img_extension='png')
+        if do_featurewise_norm:
+            png_list, _ = meta_man.get_flatten_img_list()
+            featurewise_mean, featurewise_std = estimate_img_list_norm(
+                png_list, img_size, img_scale)
+            print "Featurewise mean and std re-estimated on the png cache:", \
+                featurewise_mean, featurewise_std
     if multi_view:
         exam_list = meta_man.get_flatten_exam_list()
         exam_train, exam_val = train_test_split(
@@ -59,72 +198,138 @@ def run(img_folder, img_extension='dcm',
             stratify=meta_man.exam_labs(exam_list))
         val_size_ = len(exam_val)*2  # L and R.
     else:
+        # Split on integer indices and gather with fancy indexing instead of 
+        # letting the splitter copy lists of path strings.
         img_list, lab_list = meta_man.get_flatten_img_list()
-        img_train, img_val, lab_train, lab_val = train_test_split(
-            img_list, lab_list, test_size=val_size, random_state=random_seed, 
-            stratify=lab_list)
+        img_arr = np.asarray(img_list)
+        lab_arr = np.asarray(lab_list, dtype=np.int8)
+        idx_train, idx_val = train_test_split(
+            np.arange(len(img_arr)), test_size=val_size, 
+            random_state=random_seed, stratify=lab_arr)
+        img_train, img_val = img_arr[idx_train], img_arr[idx_val]
+        lab_train, lab_val = lab_arr[idx_train], lab_arr[idx_val]
         val_size_ = len(img_val)
 
-    # Create image generator.
-    img_gen = DMImageDataGenerator(
+    # An exam batch contains both breasts.
+    samples_per_batch = batch_size*2 if multi_view else batch_size
+    steps_per_epoch = int(np.ceil(
+        float(samples_per_epoch)/samples_per_batch/nb_proc))
+    validation_steps = int(np.ceil(float(val_size_)/samples_per_batch))
+    # Batches are built by worker processes unless worker_threads is set.
+    use_multiprocessing = nb_worker > 1 and not worker_threads
+    max_queue_size = 2*nb_worker
+    # The train sequence spans all the steps of training, so that the epoch 
+    # of a batch is given by its index. See DMSequence.
+    nb_train = len(exam_train) if multi_view else len(img_train)
+    train_seq_epochs = int(np.ceil(float(steps_per_epoch*nb_epoch)/
+                                   np.ceil(float(nb_train)/batch_size)))
+
+    # Create image generators. The featurewise normalization is done by 
+    # the model.
+    train_imgen = DMImageDataGenerator(
         horizontal_flip=True, 
-        vertical_flip=True)
-    if do_featurewise_norm:
-        img_gen.featurewise_center = True
-        img_gen.featurewise_std_normalization = True
-        img_gen.mean = featurewise_mean
-        img_gen.std = featurewise_std
-    else:
-        img_gen.samplewise_center = True
-        img_gen.samplewise_std_normalization = True
+        vertical_flip=True,
+        data_format='channels_last')
+    val_imgen = DMImageDataGenerator(data_format='channels_last')
+    if not do_featurewise_norm:
+        train_imgen.samplewise_center = True
+        train_imgen.samplewise_std_normalization = True
+        val_imgen.samplewise_center = True
+        val_imgen.samplewise_std_normalization = True
 
     if multi_view:
-        train_generator = img_gen.flow_from_exam_list(
-            exam_train, target_size=(img_size[0], img_size[1]), 
-            target_scale=img_scale,
+        train_seq = DMExamListSequence(
+            exam_train, train_imgen, 
+            target_size=(img_size[0], img_size[1]), target_scale=img_scale,
             batch_size=batch_size, balance_classes=balance_classes, 
-            all_neg_skip=all_neg_skip, shuffle=True, seed=random_seed,
-            class_mode='binary')
+            all_neg_skip=all_neg_skip, shuffle=True, seed=random_seed + rank, 
+            nb_epoch=train_seq_epochs)
+        val_seq = DMExamListSequence(
+            exam_val, val_imgen, 
+            target_size=(img_size[0], img_size[1]), target_scale=img_scale,
+            batch_size=batch_size, validation_mode=True)
         if load_val_ram:
-            val_generator = img_gen.flow_from_exam_list(
+            val_generator = val_imgen.flow_from_exam_list(
                 exam_val, target_size=(img_size[0], img_size[1]), 
                 target_scale=img_scale,
                 batch_size=val_size_, validation_mode=True, 
                 class_mode='binary')
         else:
-            val_generator = img_gen.flow_from_exam_list(
+            val_generator = val_imgen.flow_from_exam_list(
                 exam_val, target_size=(img_size[0], img_size[1]), 
                 target_scale=img_scale,
                 batch_size=batch_size, validation_mode=True, 
                 class_mode='binary')
     else:
-        train_generator = img_gen.flow_from_img_list(
-            img_train, lab_train, target_size=(img_size[0], img_size[1]), 
-            target_scale=img_scale,
+        if npy_cache is not None:
+            print "Loading image cache from", npy_cache
+            train_cache_file = os.path.join(npy_cache, 'train.npy')
+            val_cache_file = os.path.join(npy_cache, 'val.npy')
+            if rank == 0:
+                if not os.path.exists(npy_cache):
+                    os.makedirs(npy_cache)
+                create_npy_cache(
+                    img_train, train_cache_file, img_size, quantize=cache_uint8)
+                create_npy_cache(
+                    img_val, val_cache_file, img_size, quantize=cache_uint8)
+            _hvd_barrier(use_horovod)
+            train_cache = create_npy_cache(
+                img_train, train_cache_file, img_size, quantize=cache_uint8)
+            val_cache = create_npy_cache(
+                img_val, val_cache_file, img_size, quantize=cache_uint8)
+            if cache_uint8 and do_featurewise_norm:
+                featurewise_mean, featurewise_std = \
+                    estimate_featurewise_norm(train_cache, img_scale)
+                print "Featurewise mean and std re-estimated on the cache:", \
+                    featurewise_mean, featurewise_std
+        else:
+            train_cache = val_cache = None
+            train_cache_file = val_cache_file = None
+        # The sequences get the cache files, which are memory mapped by 
+        # each worker process.
+        train_seq = DMImgListSequence(
+            img_train, lab_train, train_imgen, 
+            target_size=(img_size[0], img_size[1]), target_scale=img_scale,
             batch_size=batch_size, balance_classes=balance_classes, 
-            all_neg_skip=all_neg_skip, shuffle=True, seed=random_seed,
-            class_mode='binary')
+            all_neg_skip=all_neg_skip, shuffle=True, seed=random_seed + rank, 
+            nb_epoch=train_seq_epochs, img_cache=train_cache_file, 
+            # worker processes copy every batch anyway; a batch may be 
+            # overwritten once max_queue_size + 2 batches are in flight.
+            nb_buffer=0 if use_multiprocessing else max_queue_size + 3)
+        # worker processes must not each replay a copy of an iterator.
+        val_seq = DMImgListSequence(
+            img_val, lab_val, val_imgen, 
+            target_size=(img_size[0], img_size[1]), target_scale=img_scale,
+            batch_size=batch_size, validation_mode=True, 
+            img_cache=val_cache_file)
         if load_val_ram:
-            val_generator = img_gen.flow_from_img_list(
+            val_generator = val_imgen.flow_from_img_list(
                 img_val, lab_val, target_size=(img_size[0], img_size[1]), 
                 target_scale=img_scale,
                 batch_size=val_size_, validation_mode=True,
-                class_mode='binary')
+                img_cache=val_cache, class_mode='binary')
         else:
-            val_generator = img_gen.flow_from_img_list(
+            val_generator = val_imgen.flow_from_img_list(
                 img_val, lab_val, target_size=(img_size[0], img_size[1]), 
                 target_scale=img_scale,
                 batch_size=batch_size, validation_mode=True,
-                class_mode='binary')
+                img_cache=val_cache, class_mode='binary')
 
     # Load validation set into RAM.
+    # Pack it into contiguous float32 arrays once so that predict and 
+    # evaluate can slice them without copying in every epoch.
     if load_val_ram:
-        validation_set = next(val_generator)
-        if not multi_view and len(validation_set[0]) != val_size_:
-            raise Exception
-        elif len(validation_set[0][0]) != val_size_ \
-                or len(validation_set[0][1]) != val_size_:
-            raise Exception
+        X_val, y_val = next(val_generator)
+        if multi_view:
+            X_val = [ np.ascontiguousarray(x, dtype=np.float32) for x in X_val ]
+            nb_val = [ x.shape[0] for x in X_val ]
+        else:
+            X_val = np.ascontiguousarray(X_val, dtype=np.float32)
+            nb_val = [X_val.shape[0]]
+        y_val = np.asarray(y_val, dtype=np.float32)
+        if any(n != val_size_ for n in nb_val + [len(y_val)]):
+            raise Exception('Load validation set into RAM error')
+        validation_set = (X_val, y_val)
 
     # Create model.
     if resume_from is not None:
@@ -140,95 +345,114 @@ def run(img_folder, img_extension='dcm',
             builder = MultiViewResNetBuilder
         else:
             builder = ResNetBuilder
-        if net == 'resnet18':
-            model = builder.build_resnet_18(
-                (1, img_size[0], img_size[1]), 1, nb_init_filter, init_filter_size, 
-                init_conv_stride, pool_size, pool_stride, weight_decay, alpha, l1_ratio, 
-                inp_dropout, hidden_dropout)
-        elif net == 'resnet34':
-            model = builder.build_resnet_34(
-                (1, img_size[0], img_size[1]), 1, nb_init_filter, init_filter_size, 
-                init_conv_stride, pool_size, pool_stride, weight_decay, alpha, l1_ratio, 
-                inp_dropout, hidden_dropout)
-        elif net == 'resnet50':
-            model = builder.build_resnet_50(
-                (1, img_size[0], img_size[1]), 1, nb_init_filter, init_filter_size, 
-                init_conv_stride, pool_size, pool_stride, weight_decay, alpha, l1_ratio, 
-                inp_dropout, hidden_dropout)
-        elif net == 'dmresnet14':
-            model = builder.build_dm_resnet_14(
-                (1, img_size[0], img_size[1]), 1, nb_init_filter, init_filter_size, 
-                init_conv_stride, pool_size, pool_stride, weight_decay, alpha, l1_ratio, 
-                inp_dropout, hidden_dropout)
-        elif net == 'dmresnet47rb5':
-            model = builder.build_dm_resnet_47rb5(
-                (1, img_size[0], img_size[1]), 1, nb_init_filter, init_filter_size, 
-                init_conv_stride, pool_size, pool_stride, weight_decay, alpha, l1_ratio, 
-                inp_dropout, hidden_dropout)
-        elif net == 'dmresnet56rb6':
-            model = builder.build_dm_resnet_56rb6(
-                (1, img_size[0], img_size[1]), 1, nb_init_filter, init_filter_size, 
-                init_conv_stride, pool_size, pool_stride, weight_decay, alpha, l1_ratio, 
-                inp_dropout, hidden_dropout)
-        elif net == 'dmresnet65rb7':
-            model = builder.build_dm_resnet_65rb7(
-                (1, img_size[0], img_size[1]), 1, nb_init_filter, init_filter_size, 
-                init_conv_stride, pool_size, pool_stride, weight_decay, alpha, l1_ratio, 
-                inp_dropout, hidden_dropout)
-        elif net == 'resnet101':
-            model = builder.build_resnet_101(
-                (1, img_size[0], img_size[1]), 1, nb_init_filter, init_filter_size, 
-                init_conv_stride, pool_size, pool_stride, weight_decay, alpha, l1_ratio, 
-                inp_dropout, hidden_dropout)
-        elif net == 'resnet152':
-            model = builder.build_resnet_152(
-                (1, img_size[0], img_size[1]), 1, nb_init_filter, init_filter_size, 
-                init_conv_stride, pool_size, pool_stride, weight_decay, alpha, l1_ratio, 
-                inp_dropout, hidden_dropout)
-    
+        try:
+            build_fn = getattr(builder, _NET_BUILDERS[net])
+        except KeyError:
+            raise Exception("Requested model is not available: " + net)
+        model = build_fn(
+            (1, img_size[0], img_size[1]), 1, nb_init_filter, init_filter_size, 
+            init_conv_stride, pool_size, pool_stride, weight_decay, alpha, l1_ratio, 
+            inp_dropout, hidden_dropout)
+    # Models resumed from checkpoints saved before the normalization was 
+    # moved into the graph get the normalization layer prepended as well. 
+    # The layer records how the images are preprocessed, for inference.
+    cropped = preprocess_cache is not None
+    quantized = cache_uint8 and npy_cache is not None and not multi_view
+    norm_args = get_featurewise_norm(model)
+    if do_featurewise_norm and norm_args is None:
+        model = add_featurewise_norm(model, featurewise_mean, featurewise_std, 
+                                     cropped=cropped, quantized=quantized)
+    elif do_featurewise_norm:
+        if norm_args['cropped'] != cropped:
+            raise Exception('The resumed model was trained on %s images, '
+                            'check --preprocess-cache' % 
+                            ('cropped' if norm_args['cropped'] else 'uncropped'))
+        if norm_args['quantized'] != quantized:
+            raise Exception('The resumed model was trained on %s images, '
+                            'check --cache-uint8' % 
+                            ('quantized' if norm_args['quantized'] else 'raw'))
+        if not np.allclose([norm_args['mean'], norm_args['std']], 
+                           [featurewise_mean, featurewise_std], rtol=.01):
+            print "Warning: the resumed model keeps its featurewise mean " \
+                "and std", norm_args['mean'], norm_args['std'], \
+                "instead of", featurewise_mean, featurewise_std
+
     if gpu_count > 1:
-        model = make_parallel(model, gpu_count)
+        print "Make the model parallel on %d GPUs" % (gpu_count)
+        # the parallel model saves the underlying single-GPU model.
+        model, _ = make_parallel(model, gpu_count)
 
     # Model training.
-    sgd = SGD(lr=init_lr, momentum=0.9, decay=0.0, nesterov=True)
+    clip_kwargs = {'clipnorm': clipnorm} if clipnorm > 0 else {}
+    sgd = SGD(lr=init_lr*nb_proc, momentum=0.9, decay=0.0, nesterov=True, 
+              **clip_kwargs)
+    if use_horovod:
+        sgd = hvd.DistributedOptimizer(sgd)
+    if mixed_precision:
+        sgd = add_loss_scaling(sgd, loss_scale)
+    sgd = accumulate_gradients(sgd, grad_accum_steps)
     model.compile(optimizer=sgd, loss='binary_crossentropy', 
                   metrics=[DMMetrics.sensitivity, DMMetrics.specificity])
-    reduce_lr = ReduceLROnPlateau(monitor='val_loss', factor=0.1, 
-                                  patience=lr_patience, verbose=1)
-    early_stopping = EarlyStopping(monitor='val_loss', patience=es_patience, verbose=1)
+    if min_delta > 0:
+        reduce_lr = ReduceLROnPlateau(monitor='val_loss', factor=0.1, 
+                                      patience=lr_patience, epsilon=min_delta, 
+                                      cooldown=1, verbose=1)
+    else:
+        reduce_lr = ReduceLROnPlateau(monitor='val_loss', factor=0.1, 
+                                      patience=lr_patience, verbose=1)
+    early_stopping = EarlyStopping(monitor='val_loss', patience=es_patience, 
+                                   min_delta=min_delta, verbose=1)
     if load_val_ram:
         auc_checkpointer = DMAucModelCheckpoint(best_model, validation_set, 
                                                 batch_size=batch_size)
     else:
         auc_checkpointer = DMAucModelCheckpoint(best_model, val_generator, 
-                                                nb_test_samples=val_size_)
+                                                test_samples=val_size_)
     # checkpointer = ModelCheckpoint(
     #     best_model, monitor='val_loss', verbose=1, save_best_only=True)
+    callbacks = [reduce_lr, early_stopping]
+    if use_horovod:
+        callbacks = [hvd.callbacks.BroadcastGlobalVariablesCallback(0), 
+                     hvd.callbacks.MetricAverageCallback()] + callbacks
+    if rank == 0:  # only the first process saves the best model.
+        callbacks.append(auc_checkpointer)
+    # Input pipeline: the Sequences build batches by index in the worker 
+    # processes (or threads, see worker_threads) while the GPU trains on 
+    # earlier ones, and the featurewise normalization runs in the model. 
+    # tf.data would need TF >= 1.4; the Docker images pin TF 1.2.
     hist = model.fit_generator(
-        train_generator, 
-        samples_per_epoch=samples_per_epoch, 
-        nb_epoch=nb_epoch,
+        train_seq, 
+        steps_per_epoch=steps_per_epoch, 
+        epochs=nb_epoch,
         class_weight={ 0: 1.0, 1: pos_cls_weight },
-        validation_data=validation_set if load_val_ram else val_generator, 
-        nb_val_samples=val_size_, 
-        callbacks=[reduce_lr, early_stopping, auc_checkpointer], 
-        nb_worker=nb_worker, 
-        pickle_safe=True,  # turn on pickle_safe to avoid a strange error.
-        verbose=2
+        validation_data=validation_set if load_val_ram else val_seq, 
+        validation_steps=validation_steps, 
+        callbacks=callbacks, 
+        verbose=2 if rank == 0 else 0,
+        workers=nb_worker,
+        use_multiprocessing=use_multiprocessing,
+        max_queue_size=max_queue_size,
+        # the Sequence shuffles by itself.
+        shuffle=False
         )
 
     # Training report.
-    min_loss_locs, = np.where(hist.history['val_loss'] == min(hist.history['val_loss']))
-    best_val_loss = hist.history['val_loss'][min_loss_locs[0]]
-    best_val_sensitivity = hist.history['val_sensitivity'][min_loss_locs[0]]
-    best_val_specificity = hist.history['val_specificity'][min_loss_locs[0]]
+    # A diverged epoch, e.g. under mixed precision, gives a NaN val loss.
+    val_loss = np.asarray(hist.history['val_loss'], dtype='float64')
     print "\n==== Training summary ===="
-    print "Minimum val loss achieved at epoch:", min_loss_locs[0] + 1
-    print "Best val loss:", best_val_loss
-    print "Best val sensitivity:", best_val_sensitivity
-    print "Best val specificity:", best_val_specificity
+    if np.all(np.isnan(val_loss)):
+        print "No finite val loss achieved in", len(val_loss), "epochs."
+    else:
+        best_idx = int(np.nanargmin(val_loss))
+        best_val_loss = float(val_loss[best_idx])
+        best_val_sensitivity = hist.history['val_sensitivity'][best_idx]
+        best_val_specificity = hist.history['val_specificity'][best_idx]
+        print "Minimum val loss achieved at epoch:", best_idx + 1
+        print "Best val loss:", best_val_loss
+        print "Best val sensitivity:", best_val_sensitivity
+        print "Best val specificity:", best_val_specificity
     
-    if final_model != "NOSAVE":
+    if final_model != "NOSAVE" and rank == 0:
         model.save(final_model)
 
     return hist
@@ -272,14 +496,35 @@ if __name__ == '__main__':
     parser.add_argument("--inp-dropout", "-id", dest="inp_dropout", type=float, default=.0)
     parser.add_argument("--hidden-dropout", "-hd", dest="hidden_dropout", type=float, default=.0)
     parser.add_argument("--init-learningrate", "-ilr", dest="init_lr", type=float, default=.01)
+    parser.add_argument("--clipnorm", dest="clipnorm", type=float, default=1.)
     parser.add_argument("--val-size", "-vs", dest="val_size", type=float, default=.2)
     parser.add_argument("--lr-patience", "-lrp", dest="lr_patience", type=int, default=5)
     parser.add_argument("--es-patience", "-esp", dest="es_patience", type=int, default=10)
+    parser.add_argument("--min-delta", dest="min_delta", type=float, default=1e-4)
     parser.add_argument("--resume-from", "-rf", dest="resume_from", type=str, default=None)
     parser.add_argument("--net", dest="net", type=str, default="resnet50")
     parser.add_argument("--loadval-ram", dest="load_val_ram", action="store_true")
     parser.add_argument("--no-loadval-ram", dest="load_val_ram", action="store_false")
     parser.set_defaults(load_val_ram=False)
+    parser.add_argument("--mixed-precision", dest="mixed_precision", action="store_true")
+    parser.add_argument("--no-mixed-precision", dest="mixed_precision", action="store_false")
+    parser.set_defaults(mixed_precision=False)
+    parser.add_argument("--loss-scale", dest="loss_scale", type=float, default=128.)
+    parser.add_argument("--xla", dest="use_xla", action="store_true")
+    parser.add_argument("--no-xla", dest="use_xla", action="store_false")
+    parser.set_defaults(use_xla=False)
+    parser.add_argument("--horovod", dest="use_horovod", action="store_true")
+    parser.add_argument("--no-horovod", dest="use_horovod", action="store_false")
+    parser.set_defaults(use_horovod=False)
+    parser.add_argument("--preprocess-cache", dest="preprocess_cache", type=str, default=None)
+    parser.add_argument("--grad-accum-steps", dest="grad_accum_steps", type=int, default=1)
+    parser.add_argument("--npy-cache", dest="npy_cache", type=str, default=None)
+    parser.add_argument("--cache-uint8", dest="cache_uint8", action="store_true")
+    parser.add_argument("--no-cache-uint8", dest="cache_uint8", action="store_false")
+    parser.set_defaults(cache_uint8=False)
+    parser.add_argument("--worker-threads", dest="worker_threads", action="store_true")
+    parser.add_argument("--no-worker-threads", dest="worker_threads", action="store_false")
+    parser.set_defaults(worker_threads=False)
     parser.add_argument("--exam-tsv", "-et", dest="exam_tsv", type=str, 
                         default="./metadata/exams_metadata.tsv")
     parser.add_argument("--no-exam-tsv", dest="exam_tsv", action="store_const", const=None)
@@ -316,12 +561,23 @@ if __name__ == '__main__':
         inp_dropout=args.inp_dropout,
         hidden_dropout=args.hidden_dropout,
         init_lr=args.init_lr,
+        clipnorm=args.clipnorm,
         val_size=args.val_size if args.val_size < 1 else int(args.val_size), 
         lr_patience=args.lr_patience, 
         es_patience=args.es_patience,
+        min_delta=args.min_delta,
         resume_from=args.resume_from,
         net=args.net,
         load_val_ram=args.load_val_ram,
+        mixed_precision=args.mixed_precision,
+        loss_scale=args.loss_scale,
+        use_xla=args.use_xla,
+        use_horovod=args.use_horovod,
+        preprocess_cache=args.preprocess_cache,
+        grad_accum_steps=args.grad_accum_steps,
+        npy_cache=args.npy_cache,
+        cache_uint8=args.cache_uint8,
+        worker_threads=args.worker_threads,
         exam_tsv=args.exam_tsv,
         img_tsv=args.img_tsv,
         best_model=args.best_model,        
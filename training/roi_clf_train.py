@@ -15,6 +15,12 @@ import exceptions
 warnings.filterwarnings('ignore', category=exceptions.UserWarning)
 
 
+def samplewise_norm(x):
+    '''Center and scale an image by its own mean and std
+    '''
+    return (x - x.mean())/(x.std() + 1e-7)
+
+
 def resize_img_dat(img_dat, img_size):
     '''Resize a train or test image ndarray dataset
     '''
@@ -64,9 +70,9 @@ def run(x_train_fn, x_test_fn, y_train_fn, y_test_fn,
             featurewise_std_normalization=True)
         imgen.fit(X_train)
     else:
-        imgen = ImageDataGenerator(
-            samplewise_center=True,
-            samplewise_std_normalization=True)
+        # The samplewise statistics of the stock generator are taken across 
+        # the channel axis, which zeros out 1-channel images.
+        imgen = ImageDataGenerator(preprocessing_function=samplewise_norm)
     imgen.rotation_range = rotation_range
     imgen.width_shift_range = width_shift_range
     imgen.height_shift_range = height_shift_range
@@ -76,8 +82,11 @@ def run(x_train_fn, x_test_fn, y_train_fn, y_test_fn,
     train_generator = imgen.flow(X_train, y_train, batch_size=batch_size, 
                                  shuffle=True, seed=12345)
     
-    X_test -= imgen.mean
-    X_test /= imgen.std
+    if do_featurewise_norm:
+        X_test -= imgen.mean
+        X_test /= imgen.std
+    else:
+        X_test = np.stack([ samplewise_norm(x) for x in X_test ])
     validation_set = (X_test, y_test)
 
     # ================= Model training ============== #